@@ -4,6 +4,9 @@
 # Copyright © 2016 Martin Ueding <dev@martin-ueding.de>
 
 import argparse
+import collections
+import concurrent.futures
+import hashlib
 import itertools
 import os.path
 import shlex
@@ -14,120 +17,356 @@ import uuid
 
 import matplotlib.pyplot as pl
 import numpy as np
-import scipy.misc
+from PIL import Image
 
-def argmax(iterable):
-    '''
-    http://stackoverflow.com/a/26726185
-    '''
-    return max(enumerate(iterable), key=lambda x: x[1])[0]
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import cupy
+    cupy.cuda.runtime.getDeviceCount()
+except Exception:
+    cupy = None
 
 def normalize_image(filename):
-    image = scipy.misc.imread(filename)
-    shape = image.shape
-    resized = scipy.misc.imresize(image, (100, 100), 'bilinear')
-    return resized, shape
+    image = Image.open(filename)
+    shape = (image.height, image.width, len(image.getbands()))
+    # For JPEG files this makes libjpeg decode at a reduced DCT scale
+    # (1/2, 1/4 or 1/8), which is almost free downsampling; for other
+    # formats it is a no-op.
+    image.draft('RGB', (200, 200))
+    resized = image.convert('RGB').resize((100, 100), Image.BILINEAR)
+    return np.asarray(resized, dtype=np.uint8), shape
+
+
+Library = collections.namedtuple('Library', ['filenames', 'thumbnails', 'shapes'])
 
 
 def get_difference(filename_1, filename_2):
     filenames = [filename_1, filename_2]
-    images = [scipy.misc.imread(name) for name in filenames]
-    shapes = [im.shape for im in images]
+    images = [Image.open(name) for name in filenames]
+    shapes = [(im.height, im.width, len(im.getbands())) for im in images]
 
     if shapes[0] < shapes[1]:
         first = images[0]
-        second = scipy.misc.imresize(images[1], shapes[0], 'bilinear')
+        second = images[1].resize(first.size, Image.BILINEAR)
     else:
         first = images[1]
-        second = scipy.misc.imresize(images[0], shapes[1], 'bilinear')
+        second = images[0].resize(first.size, Image.BILINEAR)
 
-    difference = np.subtract(first.astype(int), second.astype(int))
+    first = np.asarray(first.convert('RGB'), dtype=np.int16)
+    second = np.asarray(second.convert('RGB'), dtype=np.int16)
+    difference = np.subtract(first, second)
     average = np.mean(difference**2)
     return average
 
-phase = 1
+block_size = 512
 
-def print_phase_start(title):
-    global phase
-    print()
-    print('=== Phase {}: {} ==='.format(phase, title))
-    print()
-    phase += 1
+popcount_table = np.array([bin(x).count('1') for x in range(256)], dtype=np.uint8)
 
 
-def main():
-    options = _parse_args()
+def compute_hashes(flats):
+    '''
+    Computes a 64 bit difference hash (dHash) for every thumbnail.
 
-    errors = []
+    Each thumbnail is reduced to 8x9 grayscale blocks and every bit of
+    the hash records whether a block is brighter than its right
+    neighbor, so near-identical images end up with a small Hamming
+    distance between their hashes.
+    '''
+    count = len(flats)
+    gray = flats.reshape(count, 100, 100).astype(np.float32)
+    blocks = gray[:, :96, :99].reshape(count, 8, 12, 9, 11).mean(axis=(2, 4))
+    bits = blocks[:, :, 1:] > blocks[:, :, :-1]
+    return np.packbits(bits.reshape(count, 64), axis=1).view(np.uint64).reshape(count)
 
-    print_phase_start('Travese Paths')
-    paths = []
-    for dir in options.dirs:
-        for dirpath, dirnames, filenames in os.walk(dir):
-            print(dirpath)
-            for filename in filenames:
-                paths.append(os.path.join(dirpath, filename))
 
-    if options.limit is None:
-        limit = len(paths)
-    else:
-        limit = options.limit
+signature_limit = 0.25
 
-    print_phase_start('Read Images')
+
+def compute_signatures(flats):
+    '''
+    Computes a packed one-bit-per-pixel signature for every thumbnail by
+    thresholding against the per-image mean.
+
+    Near-duplicates flip only a few of these bits, so the signature
+    Hamming distance works as a cheap second filter between the 64 bit
+    hash and the full distance computation.
+    '''
+    bits = flats > flats.mean(axis=1, keepdims=True)
+    return np.packbits(bits, axis=1)
+
+
+cache_directory = os.path.expanduser('~/.cache/similar-images')
+
+image_extensions = {'.bmp', '.gif', '.jpeg', '.jpg', '.png', '.tif', '.tiff', '.webp'}
+
+
+def get_all_files(directory):
+    '''
+    Yields the paths of all image files below the given directory.
+
+    Uses os.scandir so the file type check reuses the information from
+    the directory listing instead of issuing another stat call per
+    entry, and skips files without an image extension right away.
+    '''
+    print(directory)
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from get_all_files(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                if os.path.splitext(entry.name)[1].lower() in image_extensions:
+                    yield entry.path
+
+
+def get_cache_path(filename):
+    stat = os.stat(filename)
+    key = '{}|{}|{}'.format(os.path.abspath(filename), stat.st_mtime, stat.st_size)
+    return os.path.join(
+        cache_directory, hashlib.sha1(key.encode()).hexdigest() + '.npz')
+
+
+def read_image(path, use_cache=True):
+    '''
+    Worker for build_library that funnels exceptions through the pool.
+
+    Normalized thumbnails are cached on disk keyed by path, modification
+    time and size, so repeated runs skip the decode and resize work.
+    '''
+    try:
+        cache_path = get_cache_path(path) if use_cache else None
+    except OSError as e:
+        return path, None, None, e
+
+    if cache_path is not None and os.path.isfile(cache_path):
+        # A truncated entry raises zipfile.BadZipFile and an empty one
+        # EOFError, so catch everything and fall through to recomputing
+        # the thumbnail, which overwrites the broken entry.
+        try:
+            with np.load(cache_path) as cached:
+                return (path, cached['normalized'],
+                        tuple(int(x) for x in cached['shape']), None)
+        except Exception:
+            pass
+
+    try:
+        normalized, shape = normalize_image(path)
+    except (ValueError, OSError) as e:
+        return path, None, None, e
+
+    if cache_path is not None:
+        os.makedirs(cache_directory, exist_ok=True)
+        # Write to a temporary file first so an interrupted run cannot
+        # leave a truncated entry behind.
+        temporary_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        with open(temporary_path, 'wb') as outfile:
+            np.savez(outfile, normalized=normalized, shape=np.array(shape))
+        os.replace(temporary_path, cache_path)
+
+    return path, normalized, shape, None
+
+
+def build_library(paths, limit, errors, use_cache=True):
+    '''
+    Reads all images into structure-of-arrays form: a list of filenames,
+    one contiguous uint8 array holding every thumbnail and an int32
+    array of the original shapes.
+    '''
+    limit = min(limit, len(paths))
     print('Have {} images to read'.format(limit))
     print()
-    i = 0
-    library = []
-    for path in paths[:limit]:
-        try:
-            normalized, shape = normalize_image(path)
-        except ValueError as e:
-            errors.append(e)
-        except OSError as e:
-            errors.append(e)
-        else:
-            library.append((path, normalized, shape))
-
-        i += 1
-        if i % 20 == 0:
-            print('{:5d} {}'.format(i, filename))
+    filenames = []
+    thumbnails = np.empty((limit, 100, 100, 3), dtype=np.uint8)
+    shapes = np.empty((limit, 3), dtype=np.int32)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        results = executor.map(
+            read_image, paths[:limit], itertools.repeat(use_cache),
+            chunksize=16)
+        for i, (path, normalized, shape, error) in enumerate(results, start=1):
+            if error is not None:
+                errors.append(error)
+            else:
+                thumbnails[len(filenames)] = normalized
+                shapes[len(filenames)] = shape
+                filenames.append(path)
+
+            if i % 20 == 0:
+                print('{:5d} {}'.format(i, path))
+
+    count = len(filenames)
+    return Library(filenames, thumbnails[:count], shapes[:count])
+
+
+def get_pair_mean_squares(flats, candidates_i, candidates_j, max_mean_square):
+    '''
+    Computes the mean squared difference for the given candidate pairs.
 
+    Pairs whose distance is already known to exceed max_mean_square may
+    be reported as inf instead of their exact value; the vectorized
+    fallback has no early exit and always returns exact values.
+    '''
+    dim = flats.shape[1]
+    sq = np.einsum('ij,ij->i', flats, flats, dtype=np.int64).astype(np.float32)
+    mean_squares = np.empty(len(candidates_i), dtype=np.float32)
+    for c0 in range(0, len(candidates_i), block_size):
+        ci = candidates_i[c0:c0 + block_size]
+        cj = candidates_j[c0:c0 + block_size]
+        block_i = flats[ci].astype(np.float32)
+        block_j = flats[cj].astype(np.float32)
+        dots = (block_i * block_j).sum(axis=1)
+        mean_squares[c0:c0 + block_size] = (sq[ci] + sq[cj] - 2.0 * dots) / dim
+    # The subtraction can go slightly negative for identical images due
+    # to rounding; clamp so the sqrt for the histogram stays defined.
+    np.maximum(mean_squares, 0.0, out=mean_squares)
+    return mean_squares
+
+
+if numba is not None:
+    @numba.njit(parallel=True, nogil=True, cache=True)
+    def get_pair_mean_squares(flats, candidates_i, candidates_j, max_mean_square):
+        dim = flats.shape[1]
+        mean_squares = np.empty(len(candidates_i), dtype=np.float32)
+        for p in numba.prange(len(candidates_i)):
+            row_i = flats[candidates_i[p]]
+            row_j = flats[candidates_j[p]]
+            # The running sum only grows, so once it passes the
+            # threshold the pair cannot be a duplicate anymore and the
+            # rest of the row does not need to be read.
+            limit = max_mean_square * dim
+            total = 0
+            k0 = 0
+            while k0 < dim and total <= limit:
+                k1 = min(k0 + 1000, dim)
+                for k in range(k0, k1):
+                    difference = int(row_i[k]) - int(row_j[k])
+                    total += difference * difference
+                k0 = k1
+            if k0 < dim:
+                mean_squares[p] = np.inf
+            else:
+                mean_squares[p] = total / dim
+        return mean_squares
+
+
+def get_doubles(library, max_average, hamming_limit):
+    count = len(library.filenames)
+    if count == 0:
+        return {}, []
+
+    # Luminance alone is nearly as discriminative as full RGB for
+    # duplicate detection and cuts the compared data by a factor three.
+    luminance = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    flats = np.ascontiguousarray(np.round(
+        library.thumbnails @ luminance).astype(np.uint8).reshape(count, -1))
+    max_mean_square = max_average ** 2
+
+    hashes = compute_hashes(flats)
+
+    # The all-pairs Hamming scan runs on the GPU when CuPy finds a CUDA
+    # device, otherwise on the CPU with the same expressions.
+    if cupy is None:
+        xp = np
+        device_hashes = hashes
+        table = popcount_table
+    else:
+        xp = cupy
+        device_hashes = cupy.asarray(hashes)
+        table = cupy.asarray(popcount_table)
+
+    candidates_i = []
+    candidates_j = []
+    for i0 in range(0, count, block_size):
+        print('Working on {:d} of {:d} …'.format(i0, count))
+        hashes_i = device_hashes[i0:i0 + block_size]
+        for j0 in range(i0, count, block_size):
+            hashes_j = device_hashes[j0:j0 + block_size]
+            xored = hashes_i[:, None] ^ hashes_j[None, :]
+            hamming = table[xored.view(xp.uint8)].reshape(
+                len(hashes_i), len(hashes_j), 8).sum(axis=-1)
+
+            ii = xp.arange(i0, i0 + len(hashes_i))[:, None]
+            jj = xp.arange(j0, j0 + len(hashes_j))[None, :]
+            upper = ii < jj
+
+            hits = xp.argwhere(upper & (hamming <= hamming_limit))
+            if xp is not np:
+                hits = hits.get()
+            for row, col in hits:
+                candidates_i.append(i0 + row)
+                candidates_j.append(j0 + col)
+
+    candidates_i = np.array(candidates_i, dtype=np.intp)
+    candidates_j = np.array(candidates_j, dtype=np.intp)
+    print('Have {} candidate pairs from the hash scan'.format(len(candidates_i)))
+
+    signatures = compute_signatures(flats)
+    max_differing = signature_limit * flats.shape[1]
+    keep = np.empty(len(candidates_i), dtype=bool)
+    for c0 in range(0, len(candidates_i), block_size):
+        ci = candidates_i[c0:c0 + block_size]
+        cj = candidates_j[c0:c0 + block_size]
+        differing = popcount_table[signatures[ci] ^ signatures[cj]].sum(
+            axis=1, dtype=np.int64)
+        keep[c0:c0 + block_size] = differing < max_differing
+    candidates_i = candidates_i[keep]
+    candidates_j = candidates_j[keep]
+    print('Have {} candidate pairs to check exactly'.format(len(candidates_i)))
+
+    mean_squares = get_pair_mean_squares(
+        flats, candidates_i, candidates_j, max_mean_square)
+    averages = np.sqrt(mean_squares[np.isfinite(mean_squares)]).tolist()
+    close_pairs = [
+        (int(candidates_i[idx]), int(candidates_j[idx]))
+        for idx in np.flatnonzero(mean_squares < max_mean_square)
+    ]
 
-    print_phase_start('Find Duplicates')
-    averages = []
     doubles = {}
-    for i in range(len(library)):
-        print('Working on {:d} of {:d} …'.format(i, limit))
-
-        if any(i in seconds for first, seconds in doubles.items()):
-            print('Skipping {} because it is marked as a double already'.format(i))
+    claimed = set()
+    skipped = 0
+    for i, j in sorted(close_pairs):
+        if i in claimed:
+            skipped += 1
             continue
+        if i not in doubles:
+            doubles[i] = []
+        doubles[i].append(j)
+        claimed.add(j)
 
-        filename1, normalized1, shape1 = library[i]
-        for j in range(i + 1, len(library)):
-            filename2, normalized2, shape2 = library[j]
+    marked = sum(len(js) for js in doubles.values())
+    print('Marked {} duplicates in {} sets; skipped {} pairs of claimed images'.format(
+        marked, len(doubles), skipped))
 
-            try:
-                difference = np.subtract(normalized1.astype(int), normalized2.astype(int))
-                average = np.mean(np.abs(difference))
-            except ValueError as e:
-                errors.append(e)
-                continue
+    return doubles, averages
 
-            averages.append(average)
 
-            if average < options.average:
-                print('Marking {} as a duplicate of {}.'.format(j, i))
-                if i not in doubles:
-                    doubles[i] = []
-                doubles[i].append(j)
+def write_proof_images(job):
+    filename_keep, filename_move, normalized_keep, normalized_move, base = job
+    subprocess.check_call([
+        'montage', filename_keep, filename_move,
+        '-geometry', '200x200>+4+3',
+        base + '-proof.jpg'])
+    Image.fromarray(normalized_keep).save(base + '-keep.jpg')
+    Image.fromarray(normalized_move).save(base + '-move.jpg')
 
-    print_phase_start('Find Best Image in Set')
+
+def find_best_in_set(library, doubles, moveto):
+    '''
+    Picks the image to keep from every duplicate cluster and prepares
+    the moves for the remaining ones.
+
+    The montage calls for the proof images run in a thread pool because
+    every invocation pays the full ImageMagick process startup.
+    '''
     moves = []
+    proof_jobs = []
     for i, js in doubles.items():
         candidate_ids = [i] + js
-        shapes = [library[c][2] for c in candidate_ids]
-        best_idx = argmax(shapes)
+        shapes = [tuple(int(x) for x in library.shapes[c]) for c in candidate_ids]
+        pixels = library.shapes[candidate_ids, 0] * library.shapes[candidate_ids, 1]
+        best_idx = int(np.argmax(pixels))
         best_i = candidate_ids[best_idx]
         move_idxs = list(range(len(js) + 1))
         del move_idxs[best_idx]
@@ -140,30 +379,88 @@ def main():
         print('Keeping {}; deleting {}.'.format(best_i, ', '.join(map(str, candidate_ids))))
         print('Keeping {}; deleting {}.'.format(shape_keep, ', '.join(map(str, shapes_move))))
 
-        if options.moveto is None:
+        if moveto is None:
             continue
 
-        filename_keep, normalized_keep, shape_keep = library[best_i]
+        filename_keep = library.filenames[best_i]
+        normalized_keep = library.thumbnails[best_i]
         for candidate_id in candidate_ids:
-            filename_move, normalized_move, shape_move = library[candidate_id]
+            filename_move = library.filenames[candidate_id]
+            normalized_move = library.thumbnails[candidate_id]
 
-            destination = os.path.join(options.moveto, os.path.basename(filename_move))
+            destination = os.path.join(moveto, os.path.basename(filename_move))
             while os.path.isfile(destination):
                 base, ext = os.path.splitext(filename_move)
                 destination = os.path.join(
-                    options.moveto,
+                    moveto,
                     uuid.uuid4().hex + ext)
 
             moves.append((filename_move, destination))
 
             base, ext = os.path.splitext(destination)
-            subprocess.check_call([
-                'montage', filename_keep, filename_move,
-                '-geometry', '200x200>+4+3',
-                base + '-proof.jpg'])
+            proof_jobs.append(
+                (filename_keep, filename_move, normalized_keep, normalized_move, base))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(write_proof_images, proof_jobs))
+
+    return moves
 
-            scipy.misc.imsave(base + '-keep.jpg', normalized_keep)
-            scipy.misc.imsave(base + '-move.jpg', normalized_move)
+
+def generate_histogram(averages):
+    '''
+    Writes the distance histogram, binning with NumPy and drawing a
+    single figure that is saved twice instead of letting matplotlib bin
+    the data for each output file.
+    '''
+    counts, edges = np.histogram(averages, bins=200)
+    centers = 0.5 * (edges[:-1] + edges[1:])
+
+    fig, ax = pl.subplots()
+    ax.bar(centers, counts, width=edges[1] - edges[0])
+    ax.grid(True)
+    ymin, ymax = ax.get_ylim()
+    ax.set_ylim(0.1, ymax)
+    ax.set_yscale('log')
+    fig.savefig('hist.pdf')
+
+    ax.set_xlim(-1, 50)
+    fig.savefig('hist-50.pdf')
+    pl.close(fig)
+
+
+phase = 1
+
+def print_phase_start(title):
+    global phase
+    print()
+    print('=== Phase {}: {} ==='.format(phase, title))
+    print()
+    phase += 1
+
+
+def main():
+    options = _parse_args()
+
+    errors = []
+
+    print_phase_start('Travese Paths')
+    paths = list(itertools.chain.from_iterable(
+        get_all_files(dir) for dir in options.dirs))
+
+    if options.limit is None:
+        limit = len(paths)
+    else:
+        limit = options.limit
+
+    print_phase_start('Read Images')
+    library = build_library(paths, limit, errors, not options.no_cache)
+
+    print_phase_start('Find Duplicates')
+    doubles, averages = get_doubles(library, options.average, options.hamming_limit)
+
+    print_phase_start('Find Best Image in Set')
+    moves = find_best_in_set(library, doubles, options.moveto)
 
     if not options.dry:
         print_phase_start('Move Files')
@@ -172,15 +469,7 @@ def main():
                 shutil.move(source, dest)
 
     print_phase_start('Generate Histogram')
-    pl.hist(averages, bins=200)
-    pl.grid(True)
-    ymin, ymax = pl.ylim()
-    pl.ylim(0.1, ymax)
-    pl.yscale('log')
-    pl.savefig('hist.pdf')
-
-    pl.xlim(-1, 50)
-    pl.savefig('hist-50.pdf')
+    generate_histogram(averages)
 
     if len(errors) > 0:
         print_phase_start('Print Errors')
@@ -203,7 +492,9 @@ def _parse_args():
     parser.add_argument('--limit', type=int)
     parser.add_argument('--moveto')
     parser.add_argument('--dry', action='store_true')
+    parser.add_argument('--no-cache', action='store_true')
     parser.add_argument('--average', type=int, default=2, help='default %(default)s')
+    parser.add_argument('--hamming-limit', type=int, default=8, help='default %(default)s')
     options = parser.parse_args()
 
     return options